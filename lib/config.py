@@ -1,7 +1,7 @@
-import uos
-
 import ujson as json
 
+from lib.files import file_exists
+
 NIOMON_SERVICE = "http://unsafe.niomon.{}.ubirch.com"
 DATA_SERVICE = "https://data.{}.ubirch.com/v1"
 BOOTSTRAP_SERVICE = "https://api.console.{}.ubirch.com/ubirch-web-ui/api/v1/devices/bootstrap"
@@ -46,14 +46,14 @@ def load_config(sd_card_mounted: bool = False) -> dict:
 
     # overwrite default config with user config if there is one
     user_config = "config.json"
-    if user_config in uos.listdir():
+    if file_exists(user_config):
         with open(user_config, 'r') as c:
             user_cfg = json.load(c)
             cfg.update(user_cfg)
 
     # overwrite existing config with config from sd card if there is one
     sd_config = 'config.txt'
-    if sd_card_mounted and sd_config in uos.listdir('/sd'):
+    if sd_card_mounted and file_exists('/sd/' + sd_config):
         with open('/sd/' + sd_config, 'r') as c:
             api_config = json.load(c)
             cfg.update(api_config)
@@ -49,7 +49,7 @@ class NB_IoT(Connection):
         if self.lte.isconnected():
             return
 
-        if not self.lte.isattached(): self.attach()
+        self.attach()  # returns directly, if already attached
 
         print("\tconnecting to the NB-IoT network", end="")
         self.lte.connect()  # start a data session and obtain an IP address
@@ -107,6 +107,7 @@ class WIFI(Connection):
                     self.wlan.connect(ssid, auth=(net.sec, password), timeout=5000)
                     while not self.wlan.isconnected():
                         machine.idle()  # save power while waiting
+                        time.sleep_ms(100)
                     print('\twifi network connected')
                     print('\tIP address: {}\n'.format(self.wlan.ifconfig()))
                     return
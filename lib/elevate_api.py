@@ -24,16 +24,17 @@ def _send_request(url: str, data: bytes, headers: dict) -> (int, bytes):
     return status_code, content
 
 
-def _get_request(url: str, headers: dict) -> (int, bytes):
+def _get_request(url: str, headers: dict, want_body: bool = True) -> (int, bytes):
     """
     Send a http get request to the backend.
     :param url: the backend service URL
     :param headers: the headers for the request
+    :param want_body: if False, the response body is only read for status code 200
     :return: the backend response status code, the backend response content (body)
     """
     r = requests.get(url=url, headers=headers)
     status_code = r.status_code
-    content = r.content
+    content = r.content if want_body or status_code == 200 else b""
     r.close()
     return status_code, content
 
@@ -42,9 +43,12 @@ class ElevateAPI:
     """elevate API accessor methods."""
 
     def __init__(self, cfg: dict):
-        self.debug = True
-        # cfg['debug']
+        self.debug = cfg['debug']
         self.data_url = cfg['elevateDataUrl'] + cfg['elevateDeviceId']
+        # the request URLs only depend on the config, so build them only once
+        self._send_data_url = self.data_url + "?reduceHeaders=1"
+        self._get_state_url = self.data_url + "?reduceHeaders=1&include=properties.firmwareLogLevel," \
+                                              "properties.firmwareState&exclude=_id"
         self._elevate_headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json',
@@ -61,15 +65,16 @@ class ElevateAPI:
         """
         if self.debug:
             print("** sending data message to " + self.data_url)
-        return _send_request(url=self.data_url + "?reduceHeaders=1",
+        return _send_request(url=self._send_data_url,
                              data=message,
                              headers=self._elevate_headers)
 
-    def get_state(self, uuid: UUID, message: bytes) -> (int, str, str):
+    def get_state(self, uuid: UUID, message: bytes, want_body: bool = True) -> (int, str, str):
         """
         Get the state information from the elevate backend.
         :param uuid: UNUSED
         :param message: UNUSED
+        :param want_body: if False, the response body of an erroneous request is not read
         :return: the server response status code, logging level, state-machine state
         """
         log_level = ""
@@ -77,8 +82,8 @@ class ElevateAPI:
         if self.debug:
             print("** getting the current state from " + self.data_url)
 
-        r, c = _get_request(url=self.data_url + "?reduceHeaders=1&include=properties.firmwareLogLevel,properties.firmwareState&exclude=_id",
-                            headers=self._elevate_headers)
+        r, c = _get_request(url=self._get_state_url,
+                            headers=self._elevate_headers, want_body=want_body)
         if r == 200:
             state_info = json.loads(c)
             # print("dump", json.dumps(state_info))
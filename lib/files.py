@@ -0,0 +1,14 @@
+import uos as os
+
+
+def file_exists(filename: str) -> bool:
+    """
+    Check if a file exists, without listing the directory.
+    :param filename: file to look up
+    :return: True, if the file exists
+    """
+    try:
+        os.stat(filename)
+        return True
+    except OSError:
+        return False
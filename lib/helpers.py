@@ -1,14 +1,19 @@
+import ubinascii
 import uos as os
+import ustruct as struct
 import utime as time
 from uuid import UUID
 import gc
 
 import machine
+import pycom
+from micropython import const
 
 from lib.modem import Modem
 import lib.ubirch as ubirch
 import lib.logging as logging
 from lib.connection import Connection
+from lib.files import file_exists
 
 ########
 # LED color codes
@@ -42,6 +47,9 @@ COLOR_CONFIG_FAIL = LED_YELLOW_BRIGHT
 COLOR_MODEM_FAIL = LED_PINK_BRIGHT
 COLOR_UNKNOWN_FAIL = LED_WHITE_BRIGHT
 
+# sleep between the idle calls, while waiting for the watchdog to reset the system
+IDLE_INTERVAL_MS = const(500)
+
 
 ########
 log = logging.getLogger()
@@ -53,6 +61,16 @@ def garbage_collector_setup():
     log.debug("garbage collector threshold = {} Byte".format(gc.threshold()))
 
 
+def idle_until_reset():
+    """
+    Idle until the watchdog resets the system.
+    The sleep between the idle calls keeps the CPU from waking up all the time.
+    """
+    while True:
+        machine.idle()
+        time.sleep_ms(IDLE_INTERVAL_MS)
+
+
 def mount_sd():
     try:
         sd = machine.SD()
@@ -70,14 +88,14 @@ def mount_sd():
 def store_imsi(imsi: str):
     # save imsi to file on SD, SD needs to be mounted
     imsi_file = "imsi.txt"
-    if imsi_file not in os.listdir('/sd'):
+    if not file_exists('/sd/' + imsi_file):
         log.debug("writing IMSI to SD")
         with open('/sd/' + imsi_file, 'w') as f:
             f.write(imsi)
 
 
 def get_pin_from_flash(pin_file: str, imsi: str) -> str or None:
-    if pin_file in os.listdir():
+    if file_exists(pin_file):
         log.debug("loading PIN for " + imsi)
         with open(pin_file, "rb") as f:
             return f.readline().decode()
@@ -88,7 +106,7 @@ def get_pin_from_flash(pin_file: str, imsi: str) -> str or None:
 
 def del_pin_from_flash(pin_file : str) -> bool:
     """ deletes the given pin_file; returns true if found and deleted """
-    if pin_file in os.listdir():
+    if file_exists(pin_file):
         os.remove(pin_file)
 
         return True
@@ -96,7 +114,34 @@ def del_pin_from_flash(pin_file : str) -> bool:
     return False
 
 
-def send_backend_data(sim: ubirch.SimProtocol, modem: Modem, conn: Connection, api_function, uuid, data) -> (int, bytes):
+# key in the non-volatile storage, which marks the modem as usable after the next soft reset
+MODEM_OK_NVS_KEY = "modem_ok"
+
+
+def get_modem_ok() -> bool:
+    """ returns true if the modem was marked as usable before the last reset """
+    try:
+        return pycom.nvs_get(MODEM_OK_NVS_KEY) == 1
+    except Exception:
+        # the key does not exist
+        return False
+
+
+def set_modem_ok(ok: bool) -> None:
+    """ marks the modem as usable (or not) in the non-volatile storage, so it is kept over a reset """
+    if ok:
+        pycom.nvs_set(MODEM_OK_NVS_KEY, 1)
+    elif get_modem_ok():
+        pycom.nvs_erase(MODEM_OK_NVS_KEY)
+
+
+def send_backend_data(sim: ubirch.SimProtocol, modem: Modem, conn: Connection, api_function, uuid, data,
+                      want_body: bool = True) -> (int, bytes):
+    """
+    Send data to the backend by calling the given api function, with reconnects/modem resets if necessary.
+    :param want_body: if False, the api function is told to skip the response body of erroneous requests
+    :return: the return value of the api function
+    """
     MAX_MODEM_RESETS = 1  # number of retries with modem reset before giving up
     MAX_RECONNECTS = 1  # number of retries with reconnect before trying a modem reset
 
@@ -119,9 +164,11 @@ def send_backend_data(sim: ubirch.SimProtocol, modem: Modem, conn: Connection, a
                     conn.ensure_connection()
                 try:
                     log.info("sending...")
-                    return api_function(uuid, data)
+                    if want_body:
+                        return api_function(uuid, data)
+                    return api_function(uuid, data, want_body=False)
                 except Exception as e:
-                    log.debug("sending failed: {}".format(e))
+                    log.debug("sending failed: %s", e)
                     # (continues to top of send_attempts loop)
             else:
                 # all send attempts used up
@@ -140,7 +187,7 @@ def bootstrap(imsi: str, api: ubirch.UbirchAPI) -> str:
     """
     log.info("bootstrapping SIM identity " + imsi)
     status_code, content = api.bootstrap_sim_identity(imsi)
-    if not 200 <= status_code < 300:
+    if status_code < 200 or status_code >= 300:
         raise Exception("bootstrapping failed: ({}) {}".format(status_code, str(content)))
 
     from ujson import loads
@@ -188,31 +235,43 @@ def serialize_json(msg: dict) -> bytes:
     :param msg: the json object (dict) to serialize
     :return: the compact sorted rendering
     """
-    serialized = "{"
+    parts = []
+    _serialize_json_parts(msg, parts)
+    return "".join(parts).encode()
+
+
+def _serialize_json_parts(msg: dict, parts: list) -> None:
+    """
+    append the compact sorted rendering of a json object to a list of strings,
+    so the rendering is joined only once, also for nested objects
+    :param msg: the json object (dict) to serialize
+    :param parts: list to append the rendered strings to
+    """
+    parts.append("{")
+    separator = ""
     for key in sorted(msg):
-        serialized += "\"{}\":".format(key)
+        parts.append("{}\"{}\":".format(separator, key))
+        separator = ","
         value = msg[key]
         value_type = type(value)
         if value_type is str:
-            serialized += "\"{:s}\"".format(value)
+            parts.append("\"{:s}\"".format(value))
         elif value_type is int:
-            serialized += "{:d}".format(value)
+            parts.append("{:d}".format(value))
         elif isinstance(value, float):
-            serialized += "{:.4f}".format(value)  # modified for elevate
+            parts.append("{:.4f}".format(value))  # modified for elevate
         elif value_type is dict:
-            serialized += serialize_json(value).decode()
+            _serialize_json_parts(value, parts)
         elif value_type is bool:
             if value:
-                serialized += "true"
+                parts.append("true")
             else:
-                serialized += "false"
+                parts.append("false")
         elif value is None:
-            serialized += "null"
+            parts.append("null")
         else:
             raise Exception("unsupported data type {} for serialization in json message".format(value_type))
-        serialized += ","
-    serialized = serialized.rstrip(",") + "}"  # replace last comma with closing braces
-    return serialized.encode()
+    parts.append("}")
 
 
 def get_upp_payload(upp: bytes) -> bytes:
@@ -242,13 +301,13 @@ def write_backlog(unsent_msgs: list, backlog_file: str, max_len: int) -> None:
     """
     # if there are no unsent messages, remove backlog file
     if not unsent_msgs:
-        if backlog_file in os.listdir():
+        if file_exists(backlog_file):
             os.remove(backlog_file)
         return
 
-    # do not let backlog grow too big
-    while len(unsent_msgs) > max_len:
-        unsent_msgs.pop(0)  # throw away the oldest message
+    # do not let backlog grow too big, throw away the oldest messages
+    if len(unsent_msgs) > max_len:
+        unsent_msgs = unsent_msgs[-max_len:]
 
     # store unsent messages
     with open(backlog_file, 'w') as file:
@@ -256,22 +315,130 @@ def write_backlog(unsent_msgs: list, backlog_file: str, max_len: int) -> None:
             file.write(msg + "\n")
 
 
+def append_backlog(new_msgs: list, backlog_file: str) -> None:
+    """
+    append new unsent messages to backlog file in flash, without rewriting the messages already stored there
+    """
+    with open(backlog_file, 'a') as file:
+        for msg in new_msgs:
+            file.write(msg + "\n")
+
+
 def get_backlog(backlog_file: str) -> list:
     """
     get unsent messages from backlog file in flash
     """
     backlog = []
-    if backlog_file in os.listdir():
+    if file_exists(backlog_file):
         with open(backlog_file, 'r') as file:
             for line in file:
                 backlog.append(line.rstrip("\n"))
     return backlog
 
 
+def _write_upps(file, upps: list) -> None:
+    """
+    write UPPs to an open binary file, each one prefixed with its length as 2 byte big endian
+    """
+    for upp in upps:
+        file.write(struct.pack(">H", len(upp)))
+        file.write(upp)
+
+
+def write_upp_backlog(unsent_upps: list, backlog_file: str, max_len: int) -> None:
+    """
+    write unsent UPPs to backlog file in flash, the UPPs are stored as raw bytes with a length prefix
+    """
+    # if there are no unsent UPPs, remove backlog file
+    if not unsent_upps:
+        if file_exists(backlog_file):
+            os.remove(backlog_file)
+        return
+
+    # do not let backlog grow too big, throw away the oldest UPPs
+    if len(unsent_upps) > max_len:
+        unsent_upps = unsent_upps[-max_len:]
+
+    # store unsent UPPs
+    with open(backlog_file, 'wb') as file:
+        _write_upps(file, unsent_upps)
+
+
+def append_upp_backlog(new_upps: list, backlog_file: str) -> None:
+    """
+    append new unsent UPPs to backlog file in flash, without rewriting the UPPs already stored there
+    """
+    with open(backlog_file, 'ab') as file:
+        _write_upps(file, new_upps)
+
+
+def get_upp_backlog(backlog_file: str) -> list:
+    """
+    get unsent UPPs from backlog file in flash as raw bytes
+    """
+    backlog = []
+    if file_exists(backlog_file):
+        with open(backlog_file, 'rb') as file:
+            data = file.read()
+        index = 0
+        # a truncated last UPP (e.g. power loss while writing) is dropped
+        while index + 2 <= len(data):
+            upp_len = struct.unpack_from(">H", data, index)[0]
+            index += 2
+            if index + upp_len > len(data):
+                break
+            backlog.append(data[index:index + upp_len])
+            index += upp_len
+    return backlog
+
+
+def migrate_upp_backlog(old_backlog_file: str, backlog_file: str, max_len: int) -> None:
+    """
+    move the UPPs from an old backlog file with one hex encoded UPP per line into the current backlog file,
+    the old UPPs are put in front of the ones already stored there, then the old file is removed
+    """
+    if not file_exists(old_backlog_file):
+        return
+
+    old_upps = []
+    with open(old_backlog_file, 'rb') as file:
+        for line in file:
+            line = line.rstrip(b"\n")
+            if line:
+                old_upps.append(ubinascii.unhexlify(line))
+
+    log.info("moving %d UPPs from %s to %s", len(old_upps), old_backlog_file, backlog_file)
+    write_upp_backlog(old_upps + get_upp_backlog(backlog_file), backlog_file, max_len)
+    os.remove(old_backlog_file)
+
+
 def formated_time():
     """Helper function to reformat time to the specific format from below."""
     ct = time.localtime()
-    return "{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}Z".format(*ct)  # modified to fit the correct format
+    return "%04d-%02d-%02dT%02d:%02d:%02dZ" % ct[:6]  # modified to fit the correct format
+
+
+# translation tables for the backend/machine values, built once at import
+_BACKEND_LOG_LEVELS = {
+    'error': logging.ERROR,
+    'warning': logging.WARNING,
+    'info': logging.INFO,
+    'debug': logging.DEBUG
+}
+
+# most backend states map to the same state-machine state
+_STATE_WAITING_FOR_OVERSHOOT = 'waitingForOvershoot'
+_BACKEND_STATES_WAITING_FOR_OVERSHOOT = {'installation', 'sensing', 'custom1', 'custom2'}
+_BACKEND_STATE_NAMES = {
+    'blinking': 'blinking',
+    'custom3': 'bootloader'
+}
+
+_RESET_CAUSES = dict(zip(
+    (machine.PWRON_RESET, machine.HARD_RESET, machine.WDT_RESET,
+     machine.DEEPSLEEP_RESET, machine.SOFT_RESET, machine.BROWN_OUT_RESET),
+    ('Power On', 'Hard', 'Watchdog', 'Deepsleep', 'Soft', 'Brown Out')
+))
 
 
 def translate_backend_log_level(log_level: str):
@@ -280,13 +447,7 @@ def translate_backend_log_level(log_level: str):
     :param log_level: logging level from backend
     :return: translated logging level for logger
     """
-    switcher = {
-        'error': logging.ERROR,
-        'warning': logging.WARNING,
-        'info': logging.INFO,
-        'debug': logging.DEBUG
-    }
-    return switcher.get(log_level, logging.INFO)
+    return _BACKEND_LOG_LEVELS.get(log_level, logging.INFO)
 
 
 def translate_backend_state_name(state: str):
@@ -295,15 +456,9 @@ def translate_backend_state_name(state: str):
     :param state: new state given from the backend
     :return: translated state for state_machine
     """
-    switcher = {
-        'installation': 'waitingForOvershoot',
-        'blinking': 'blinking',
-        'sensing': 'waitingForOvershoot',
-        'custom1': 'waitingForOvershoot',
-        'custom2': 'waitingForOvershoot',
-        'custom3': 'bootloader'
-    }
-    return switcher.get(state, 'error') # default returns error
+    if state in _BACKEND_STATES_WAITING_FOR_OVERSHOOT:
+        return _STATE_WAITING_FOR_OVERSHOOT
+    return _BACKEND_STATE_NAMES.get(state, 'error') # default returns error
 
 
 def translate_reset_cause(reset_cause: int):
@@ -312,15 +467,7 @@ def translate_reset_cause(reset_cause: int):
     :param reset_cause: from machine
     :return: translated reset cause string
     """
-    switcher = {
-        machine.PWRON_RESET: 'Power On',
-        machine.HARD_RESET: 'Hard',
-        machine.WDT_RESET: 'Watchdog',
-        machine.DEEPSLEEP_RESET: 'Deepsleep',
-        machine.SOFT_RESET: 'Soft',
-        machine.BROWN_OUT_RESET: 'Brown Out'
-    }
-    return switcher.get(reset_cause, 'Unknown')
+    return _RESET_CAUSES.get(reset_cause, 'Unknown')
 
 
 def get_current_version():
@@ -331,6 +478,32 @@ def get_current_version():
     return VERSION
 
 
+def _reversed_lines(filename: str, chunk_size: int = 512):
+    """
+    Generator, which reads a file backwards in chunks and yields its lines from the last to the first.
+    Only one chunk (plus the unfinished line) is kept in memory.
+    :param filename: file to read
+    :param chunk_size: number of bytes to read at once
+    :return: the lines of the file as bytes, without the newline
+    """
+    with open(filename, 'rb') as reader:
+        reader.seek(0, 2)
+        position = reader.tell()
+        rest = b""
+        while position > 0:
+            read_size = min(chunk_size, position)
+            position -= read_size
+            reader.seek(position)
+            lines = (reader.read(read_size) + rest).split(b"\n")
+            # the first line might continue in the previous chunk
+            rest = lines[0]
+            for i in range(len(lines) - 1, 0, -1):
+                if lines[i]:
+                    yield lines[i]
+        if rest:
+            yield rest
+
+
 def read_log(num_errors: int = 3):
     """
     Read the last ERRORs from log and form a string of json like list.
@@ -342,33 +515,33 @@ def read_log(num_errors: int = 3):
     error_counter = 0
     file_index = 1
     filename = logging.FILENAME
-    # make a list of all log files
+    # make a list of all log files, stat only looks up the single file instead of listing the whole directory
     all_logfiles_list = []
-    if filename in os.listdir():
+    if file_exists(filename):
         all_logfiles_list.append(filename)
-    while (filename + '.{}'.format(file_index)) in os.listdir():
+    while file_exists(filename + '.{}'.format(file_index)):
         all_logfiles_list.append(filename + '.{}'.format(file_index))
         file_index += 1
 
-    # iterate over all log files to get the required ERROR messages
+    # iterate over all log files (newest first) to get the required ERROR messages
     for logfile in all_logfiles_list:
-        with open(logfile, 'r') as reader:
-            lines = reader.readlines()
-        for line in reversed(lines):
-            # only take the error messages from the log
-            if "ERROR" in line[
-                          :42]:  # only look at the beginning of the line, otherwise the string can appear recursively
-                error_counter += 1
-                if error_counter > num_errors:
-                    break
-                last_log += (line.rstrip('\n'))
-                # check if the message was closed with "}", if not, add it to ensure json
-                if not "}" in line:
-                    last_log += "},"
-                else:
-                    last_log += ","
-            else:
-                pass
-        if error_counter > num_errors:
+        lines = _reversed_lines(logfile)
+        try:
+            for line in lines:
+                # only take the error messages from the log
+                if line.find(b"ERROR", 0, 42) != -1:  # only look at the beginning of the line, otherwise the string can appear recursively
+                    last_log += line.decode()
+                    # check if the message was closed with "}", if not, add it to ensure json
+                    if not b"}" in line:
+                        last_log += "},"
+                    else:
+                        last_log += ","
+                    error_counter += 1
+                    if error_counter >= num_errors:
+                        break
+        finally:
+            # make sure the log file is closed, also if the generator was not exhausted
+            lines.close()
+        if error_counter >= num_errors:
             break
-    return last_log.rstrip(',')
\ No newline at end of file
+    return last_log.rstrip(',')
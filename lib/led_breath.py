@@ -1,6 +1,7 @@
 import utime as time
 import pycom
 import math
+import micropython
 
 
 class LedBreath(object):
@@ -18,7 +19,10 @@ class LedBreath(object):
         self.period_back = self.period
         self.color_back = self.color
         self.brightness_back = self.brightness
+        # last value written to the RGB LED, None until the first update
+        self.light = None
 
+    @micropython.native
     def update(self):
         """
         Update the breathing, means to calculate the new intensity value of the light
@@ -38,8 +42,10 @@ class LedBreath(object):
         _light = (int(_intensity * _red) << 16) + \
                  (int(_intensity * _green) << 8) + \
                  (int(_intensity * _blue))
-        # set the RGBLED to the new value
-        pycom.rgbled(_light)
+        # set the RGBLED to the new value, only if it changed
+        if _light != self.light:
+            pycom.rgbled(_light)
+            self.light = _light
 
     def set_color(self, color):
         """
@@ -191,11 +191,13 @@ class Formatter:
         # The message attribute of the record is computed using msg % args.
         # print("T {1} MSG {0}".format(record.msg, type(record.msg)))
         # print("T {1} ARGS {0}".format(record.args, type(record.args)))
-        record.message = record.msg % record.args
+        # It is only computed once, also if the record is passed to several handlers.
+        if record.message is None:
+            record.message = record.msg % record.args
 
         # If the formatting string contains '(asctime)', formatTime() is called to
         # format the event time.
-        if self.usesTime():
+        if record.asctime is None and self.usesTime():
             record.asctime = self.formatTime(record, self.datefmt)
 
         # If there is exception information, it is formatted using formatException()
@@ -219,7 +221,7 @@ class Formatter:
     def formatTime(self, record, datefmt=None):
         assert datefmt is None  # datefmt is not supported
         ct = utime.localtime(record.created)
-        return "{0:04d}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:{5:02d}Z".format(*ct)  # modified to fit the correct format
+        return "%04d-%02d-%02dT%02d:%02d:%02dZ" % ct[:6]  # modified to fit the correct format
 
     def formatException(self, exc_info):
         raise NotImplementedError()
@@ -248,3 +250,5 @@ class LogRecord:
         self.exc_info = exc_info
         self.func = func
         self.sinfo = sinfo
+        self.message = None
+        self.asctime = None
@@ -37,8 +37,16 @@ class SI7006A20:
 
     def temperature(self):
         """ obtaining the temperature(degrees Celsius) measured by sensor """
-        self.i2c.writeto(SI7006A20_I2C_ADDR, bytearray([0xF3]))
+        self.start_temperature()
         time.sleep(0.5)
+        return self.read_temperature()
+
+    def start_temperature(self):
+        """ start a temperature measurement, the result can be read after 0.5 s """
+        self.i2c.writeto(SI7006A20_I2C_ADDR, bytearray([0xF3]))
+
+    def read_temperature(self):
+        """ reading the temperature(degrees Celsius) of a measurement started with start_temperature() """
         data = self.i2c.readfrom(SI7006A20_I2C_ADDR, 3)
         # print("CRC Raw temp data: " + hex(data[0]*65536 + data[1]*256 + data[2]))
         data = self._getWord(data[0], data[1])
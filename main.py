@@ -62,21 +62,27 @@ class Main:
         self.root_controller.go_to_state('initSystem')
 
     def read_loop(self):
+        last_feed_ms = time.ticks_ms()
         while True:
             try:
                 self.root_controller.update()
                 time.sleep_ms(10)
-                self.root_controller.wdt.feed() # CHECK: This way, the watchdog will never trigger as long as update() returns without exception.
-                                                # Might be worth thinking about only feeding watchdog if something meaningful is done. (I.e. in the states.)
+                now = time.ticks_ms()
+                if time.ticks_diff(now, last_feed_ms) >= WATCHDOG_FEED_INTERVAL_MS:
+                    self.root_controller.wdt.feed() # CHECK: This way, the watchdog will never trigger as long as update() returns without exception.
+                                                    # Might be worth thinking about only feeding watchdog if something meaningful is done. (I.e. in the states.)
+                    last_feed_ms = now
 
             except Exception as e:
                 print("\r\n\n\n\033[1;31mMAIN ERROR CAUGHT:  {}\033[0m\r\n\n\n".format(repr(e)))
                 try:
-                    log.exception(str(e))
+                    log.exception("Main error caught")
                 finally:
                     pass
                 time.sleep(10)
 
+                # make sure the modem is reset after the restart as well
+                set_modem_ok(False)
                 # check if the system (-> pysense) is initialised and try to reset
                 if self.root_controller.system is not None and self.root_controller.system.sensor is not None:
                     self.root_controller.system.hard_reset()
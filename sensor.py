@@ -1,13 +1,19 @@
 import pyboard
 from pyboard.LIS2HH12 import FULL_SCALE_2G, ODR_100_HZ
 import _thread
+import micropython
+from micropython import const
+import utime as time
+from array import array
 
 from sensor_config import *
 
 _thread.stack_size(8192)
 
-FIFO_VALUES = 32
-FIFO_AXIS = 3
+FIFO_VALUES = const(32)
+FIFO_AXIS = const(3)
+
+TEMPERATURE_MEASUREMENT_MS = const(500)
 
 # TODO, simplify the filtering and data
 
@@ -29,6 +35,7 @@ class MovementSensor(object):
         self.speed_min = 0.0
         self.altitude = 0.0
         self.temperature = 0.0
+        self.temperature_ready_ms = 0
         self.overshoot = False
 
         self.init_filters()
@@ -49,12 +56,27 @@ class MovementSensor(object):
         self.threadLock = _thread.allocate_lock()
         _thread.start_new_thread(self.sensor_filtering_thread, ())
 
+    def start_poll_sensors(self):
+        """
+        Start the temperature measurement, without waiting for it.
+        The values are read with poll_sensors, once sensors_ready returns True.
+        """
+        self.pysense.humidity.start_temperature()
+        self.temperature_ready_ms = time.ticks_add(time.ticks_ms(), TEMPERATURE_MEASUREMENT_MS)
+
+    def sensors_ready(self):
+        """
+        Check if the measurement started with start_poll_sensors is finished.
+        """
+        return time.ticks_diff(time.ticks_ms(), self.temperature_ready_ms) >= 0
+
     def poll_sensors(self):
         """
         Poll temperature and altitude values and store them in class attributes.
+        The temperature measurement has to be started with start_poll_sensors before.
         """
         self.altitude = self.pysense.altimeter.altitude()
-        self.temperature = self.pysense.humidity.temperature()
+        self.temperature = self.pysense.humidity.read_temperature()
 
     def accelerometer_interrupt_cb(self, pin):
         """
@@ -80,25 +102,18 @@ class MovementSensor(object):
     def init_filters(self):
         """
         Initialize the filter variables for processing.
+        The filter rows are float arrays, copied from one zero row, so updating a value does not allocate.
         """
+        zeros = array('f', [0.0] * FIFO_AXIS)
         for i in range(FIFO_VALUES):
-            self.accel_xyz.append([])
-            self.accel_smooth.append([])
-            self.accel_filtered.append([])
-            self.accel_filtered_smooth.append([])
-            self.speed.append([])
-            self.speed_smooth.append([])
-            self.speed_filtered.append([])
-            self.speed_filtered_smooth.append([])
-            for j in range(FIFO_AXIS):
-                self.accel_xyz[i].append(0.0)
-                self.accel_smooth[i].append(0.0)
-                self.accel_filtered[i].append(0.0)
-                self.accel_filtered_smooth[i].append(0.0)
-                self.speed[i].append(0.0)
-                self.speed_smooth[i].append(0.0)
-                self.speed_filtered[i].append(0.0)
-                self.speed_filtered_smooth[i].append(0.0)
+            self.accel_xyz.append([0.0] * FIFO_AXIS)
+            self.accel_smooth.append(array('f', zeros))
+            self.accel_filtered.append(array('f', zeros))
+            self.accel_filtered_smooth.append(array('f', zeros))
+            self.speed.append(array('f', zeros))
+            self.speed_smooth.append(array('f', zeros))
+            self.speed_filtered.append(array('f', zeros))
+            self.speed_filtered_smooth.append(array('f', zeros))
 
     def perform_filters(self):
         """
@@ -137,20 +152,26 @@ class MovementSensor(object):
                                                    + (1 - SPEED_FILTER2_ALPHA) * self.speed_filtered_smooth[i -1][j]
         return
 
+    @micropython.native
     def movement(self):
         """
         Calculate th maximum absolute speed value from current sensor values,
-        over all axis.
+        over all axis, in a single pass over the filtered speed values.
         :return: (indirect) Set the overshoot flag
         """
-        self.overshoot = False
-        self.speed_min = min(min(self.speed_filtered_smooth))
-        self.speed_max = max(max(self.speed_filtered_smooth))
-
-        if self.speed_max > g_THRESHOLD:
-            self.overshoot = True
-        if abs(self.speed_min) > g_THRESHOLD:
-            self.overshoot = True
+        speed_min = speed_max = self.speed_filtered_smooth[0][0]
+        for values in self.speed_filtered_smooth:
+            for value in values:
+                if value > speed_max:
+                    speed_max = value
+                elif value < speed_min:
+                    speed_min = value
+        self.speed_min = speed_min
+        self.speed_max = speed_max
+
+        # speed_min can only be above the threshold, if speed_max is as well
+        threshold = g_THRESHOLD
+        self.overshoot = speed_max > threshold or speed_min < -threshold
         return
 
     def sensor_filtering_thread(self):
@@ -2,8 +2,10 @@
 from: https://learn.adafruit.com/circuitpython-101-state-machines?view=all#code
 """
 import machine
+import micropython
 import ubinascii
 import uos as os
+from micropython import const
 import system
 
 import lib.logging as logging
@@ -13,25 +15,28 @@ from lib.realtimeclock import enable_time_sync, wait_for_sync, board_time_valid,
 
 # backlog constants
 EVENT_BACKLOG_FILE = "event_backlog.txt"
-UPP_BACKLOG_FILE = "upp_backlog.txt"
-BACKLOG_MAX_LEN = 10  # max number of events / UPPs in the backlogs
+UPP_BACKLOG_FILE = "upp_backlog.bin"
+BACKLOG_MAX_LEN = const(10)  # max number of events / UPPs in the backlogs
 
 VERSION_FILE = "OTA_VERSION.txt"
 
 # timing
-STANDARD_DURATION_S = 1
-BLINKING_DURATION_S = 60
-WAIT_FOR_TUNING_S = 30
+BLINKING_DURATION_S = const(60)
+WAIT_FOR_TUNING_S = const(30)
 
-WATCHDOG_TIMEOUT_MS = 6 * 60 * 1000
+WATCHDOG_TIMEOUT_MS = const(6 * 60 * 1000)
+WATCHDOG_FEED_INTERVAL_MS = const(1000)  # feeding more often does not help, the timeout is minutes
 
-MAX_INACTIVITY_TIME_S = 60 * 60  # min * sec
-FIRST_INTERVAL_INACTIVITY_S = MAX_INACTIVITY_TIME_S / 16  # =225 sec
-EXP_BACKOFF_INACTIVITY = 2
-OVERSHOOT_DETECTION_PAUSE_S = 60  # sec
+MAX_INACTIVITY_TIME_S = const(60 * 60)  # min * sec
+FIRST_INTERVAL_INACTIVITY_S = const(MAX_INACTIVITY_TIME_S // 16)  # =225 sec
+EXP_BACKOFF_INACTIVITY = const(2)
+OVERSHOOT_DETECTION_PAUSE_S = const(60)  # sec
 
+MAX_FAILED_BACKEND_COMMUNICATIONS = const(3)  # failed state polls in a row, before going to the error state
+
+_restart_random = os.urandom(2)
 RESTART_OFFSET_TIME_S = 24 * 60 * 60 + (
-            int.from_bytes(os.urandom(2), "big") % 0x0FFF)  # define restart time = 1 day + (0 .. 4095) seconds
+            ((_restart_random[0] & 0x0F) << 8) | _restart_random[1])  # define restart time = 1 day + (0 .. 4095) seconds
 
 # setup the logging
 log = logging.getLogger()
@@ -40,6 +45,9 @@ log.info("RESTART IN: {} s".format(RESTART_OFFSET_TIME_S))
 # get the reason for reset in readable form
 RESET_REASON = translate_reset_cause(machine.reset_cause())
 
+# get the unique id of the board in readable form
+UNIQUE_ID = ubinascii.hexlify(machine.unique_id())
+
 
 ################################################################################
 # State Machine
@@ -63,7 +71,7 @@ class StateMachine(object):
         self.startTime = 0
 
         log.info("\033[0;35m[Core] Initializing magic... \033[0m ✨ ")
-        log.info("[Core] Hello, I am %s", ubinascii.hexlify(machine.unique_id()))
+        log.info("[Core] Hello, I am %s", UNIQUE_ID)
 
     def add_state(self, state):
         """
@@ -97,7 +105,7 @@ class StateMachine(object):
             try:
                 self.state.update(self)
             except Exception as e:
-                log.exception('Uncaught exception while processing state %s: %s', self.state, str(e))
+                log.exception('Uncaught exception while processing state %s', self.state.name)
                 if 'error' in self.states:
                     self.go_to_state('error')
                 else:
@@ -123,34 +131,32 @@ class State(object):
     Abstract Parent State Class.
     """
 
+    # Name of state for state interaction.
+    # This is an abstract attribute, which has to be set in every child class
+    name = None
+    # Color of the LED breathing in this state, None to keep the current one.
+    color = None
+
     def __init__(self):
         self.enter_timestamp = 0
+        self.led_breath = None
         pass
 
-    @property
-    def name(self):
-        """
-        Name of state for state interaction.
-        This is an abstract property, which has to be implemented in every child class
-        :return name string of the state.
-        """
-        raise NotImplementedError()
-
     def enter(self, state_machine):
         """
         Enter a specific state. This is called, when a new state is entered.
         Get the timestamp for entering, so it can be used in all states
         :param state_machine: state machine, which has the state
         """
-        try:
-            log.debug('Entering {}'.format(self.name))
-            self.enter_timestamp = time.time()
-            # add the timestamp and state name to a log, for later sending
-            state_machine.timeStateLog.append(formated_time() + ":" + self.name)
-            self._enter(state_machine)
-        except Exception as e:
-            log.exception("Enter: {}".format(str(e)))
-            raise e
+        log.debug('Entering %s', self.name)
+        self.enter_timestamp = time.ticks_ms()
+        # keep a reference to the LED, so the update does not have to look it up every time
+        self.led_breath = state_machine.system.led_breath if state_machine.system is not None else None
+        if self.led_breath is not None and self.color is not None:
+            self.led_breath.set_color(self.color)
+        # add the timestamp and state name to a log, for later sending
+        state_machine.timeStateLog.append(formated_time() + ":" + self.name)
+        self._enter(state_machine)
 
     def _enter(self, state_machine):
         """
@@ -165,12 +171,8 @@ class State(object):
         Exit a specific state. This is called, when the old state is left.
         :param state_machine: state machine, which has the state.
         """
-        try:
-            log.debug('Exiting {}'.format(self.name))
-            self._exit(state_machine)
-        except Exception as e:
-            log.exception("Exit: {}".format(str(e)))
-            raise e
+        log.debug('Exiting %s', self.name)
+        self._exit(state_machine)
 
     def _exit(self, state_machine):
         """
@@ -180,6 +182,7 @@ class State(object):
         """
         raise NotImplementedError()
 
+    @micropython.native
     def update(self, state_machine):
         """
         Update the current state, which means to run through the update routine.
@@ -187,15 +190,11 @@ class State(object):
         :param state_machine: state machine, which has the state.
         :return: True, to indicate, the function was called.
         """
-        try:
-            # check if the system is already initialised - skip if it is not
-            if state_machine.system is not None:
-                state_machine.system.led_breath.update()
+        # check if the system was already initialised when entering the state - skip if it was not
+        if self.led_breath is not None:
+            self.led_breath.update()
 
-            self._update(state_machine)
-        except Exception as e:
-            log.exception("Update: {}".format(str(e)))
-            raise e
+        self._update(state_machine)
 
     def _update(self, state_machine):
         """
@@ -211,12 +210,7 @@ class StateInitSystem(State):
     Initialize the System.
     """
 
-    def __init__(self):
-        super().__init__()
-
-    @property
-    def name(self):
-        return 'initSystem'
+    name = 'initSystem'
 
     def _enter(self, state_machine):
         # TODO breath not possible here since the system class is not yet initialized
@@ -230,14 +224,13 @@ class StateInitSystem(State):
         try:
             state_machine.system = system.System()
         except OSError as e:
-            log.exception(str(e))
+            log.exception("Failed to initialise the system")
             state_machine.lastError = str(e)
 
+            set_modem_ok(False)
             machine.reset()
 
-        now = time.time()
-        if now >= self.enter_timestamp + STANDARD_DURATION_S:
-            state_machine.go_to_state('connecting')
+        state_machine.go_to_state('connecting')
 
 
 class StateConnecting(State):
@@ -245,15 +238,11 @@ class StateConnecting(State):
     Connecting State to connect to network.
     """
 
-    def __init__(self):
-        super().__init__()
-
-    @property
-    def name(self):
-        return 'connecting'
+    name = 'connecting'
+    color = LED_WHITE
 
     def _enter(self, state_machine):
-        state_machine.system.led_breath.set_color(LED_WHITE)
+        pass
 
     def _exit(self, state_machine):
         pass
@@ -276,15 +265,14 @@ class StateConnecting(State):
                 if not board_time_valid():
                     raise Exception("Time sync failed", time.time())
             # update the start time
-            state_machine.startTime = time.time()
+            state_machine.startTime = time.ticks_ms()
 
         except Exception as e:
             state_machine.lastError = str(e)
-            return False
-
-        finally:
             state_machine.system.connection.disconnect()
+            return False
 
+        # keep the connection, so it can be reused for sending the diagnostics
         return True
 
     def _update(self, state_machine):
@@ -299,15 +287,11 @@ class StateSendingDiagnostics(State):
     Sending Version Diagnostics to the backend.
     """
 
-    def __init__(self):
-        super().__init__()
-
-    @property
-    def name(self):
-        return 'sendingDiagnostics'
+    name = 'sendingDiagnostics'
+    color = LED_YELLOW
 
     def _enter(self, state_machine):
-        state_machine.system.led_breath.set_color(LED_YELLOW)
+        pass
 
     def _exit(self, state_machine):
         pass
@@ -317,7 +301,7 @@ class StateSendingDiagnostics(State):
         # check the errors in the log and send it
         last_log = read_log(2)
         if not last_log == "":
-            print("LOG: {}".format(last_log))
+            log.debug("LOG: %s", last_log)
             event = ({'properties.variables.lastLogContent': {'value': last_log}})
             state_machine.system.send_event(event)
 
@@ -336,9 +320,7 @@ class StateSendingDiagnostics(State):
 
         state_machine.system.send_event(event)
 
-        now = time.time()
-        if now >= self.enter_timestamp + STANDARD_DURATION_S:
-            state_machine.go_to_state('waitingForOvershoot')
+        state_machine.go_to_state('waitingForOvershoot')
 
 
 class StateWaitingForOvershoot(State):
@@ -347,33 +329,45 @@ class StateWaitingForOvershoot(State):
     or until waiting time was exceeded.
     """
 
+    name = 'waitingForOvershoot'
+    color = LED_PURPLE
+
     def __init__(self):
         super().__init__()
-
-    @property
-    def name(self):
-        return 'waitingForOvershoot'
+        self.restart_deadline = 0
+        self.tuning_deadline = 0
+        self.inactivity_deadline = 0
+        self.get_movement = None
 
     def _enter(self, state_machine):
-        state_machine.system.led_breath.set_color(LED_PURPLE)
+        # the modem worked until here, so it does not need a reset after a soft reset
+        state_machine.system.remember_modem_ok()
+        # keep the bound getter, so the update does not have to look it up on every tick
+        self.get_movement = state_machine.system.get_movement
+        # the deadlines do not change while waiting, so calculate them only once
+        self.restart_deadline = time.ticks_add(state_machine.startTime, RESTART_OFFSET_TIME_S * 1000)
+        self.tuning_deadline = time.ticks_add(self.enter_timestamp, WAIT_FOR_TUNING_S * 1000)
+        self.inactivity_deadline = time.ticks_add(self.enter_timestamp, state_machine.intervalForInactivityEventS * 1000)
 
     def _exit(self, state_machine):
         pass
 
+    @micropython.native
     def _update(self, state_machine):
-        now = time.time()
-        if now >= state_machine.startTime + RESTART_OFFSET_TIME_S:
+        ticks_diff = time.ticks_diff
+        now = time.ticks_ms()
+        if ticks_diff(now, self.restart_deadline) >= 0:
             log.info("its time to restart")
             state_machine.go_to_state('bootloader')
             return
 
         # wait 30 seconds for filter to tune in
-        if now >= self.enter_timestamp + WAIT_FOR_TUNING_S:
-            if state_machine.system.get_movement():  # movement:
+        if ticks_diff(now, self.tuning_deadline) >= 0:
+            if self.get_movement():  # movement:
                 state_machine.go_to_state('measuringPaused')
                 return
 
-        if now >= self.enter_timestamp + state_machine.intervalForInactivityEventS:
+        if ticks_diff(now, self.inactivity_deadline) >= 0:
             state_machine.go_to_state('inactive')
             return
 
@@ -384,36 +378,36 @@ class StateMeasuringPaused(State):
     Here the activity is transmitted to the backends
     """
 
-    def __init__(self):
-        super().__init__()
-
-    @property
-    def name(self):
-        return 'measuringPaused'
+    name = 'measuringPaused'
+    color = LED_GREEN
 
     def _enter(self, state_machine):
-        state_machine.system.led_breath.set_color(LED_GREEN)
+        state_machine.system.start_poll_sensors()
 
     def _exit(self, state_machine):
         pass
 
     def _update(self, state_machine):
         state_machine.intervalForInactivityEventS = FIRST_INTERVAL_INACTIVITY_S
-        state_machine.system.poll_sensors()
+        system = state_machine.system
+        # keep the LED breathing, while the sensors are still measuring
+        if not system.sensors_ready():
+            return
+        system.poll_sensors()
+        # read the speed values once, the filter thread might update them while building the event
+        speed_max = system.get_speed_max()
+        speed_min = system.get_speed_min()
         event = ({
             'properties.variables.isWorking': {'value': True, 'sentAt': formated_time()},
-            'properties.variables.acceleration': {
-                'value': 1 if state_machine.system.get_speed_max() > abs(state_machine.system.get_speed_min()) else -1},
-            'properties.variables.accelerationMax': {'value': state_machine.system.get_speed_max()},
-            'properties.variables.accelerationMin': {'value': state_machine.system.get_speed_min()},
-            'properties.variables.altitude': {'value': state_machine.system.get_altitude()},
-            'properties.variables.temperature': {'value': state_machine.system.get_temperature()}
+            'properties.variables.acceleration': {'value': 1 if speed_max > abs(speed_min) else -1},
+            'properties.variables.accelerationMax': {'value': speed_max},
+            'properties.variables.accelerationMin': {'value': speed_min},
+            'properties.variables.altitude': {'value': system.get_altitude()},
+            'properties.variables.temperature': {'value': system.get_temperature()}
         })
-        state_machine.system.send_event(event, ubirching=True)
+        system.send_event(event, ubirching=True)
 
-        now = time.time()
-        if now >= self.enter_timestamp + STANDARD_DURATION_S:
-            state_machine.go_to_state('waitingForOvershoot')
+        state_machine.go_to_state('waitingForOvershoot')
 
 
 class StateInactive(State):
@@ -423,17 +417,17 @@ class StateInactive(State):
     and the waiting interval is increased
     """
 
+    name = 'inactive'
+    color = LED_BLUE
+
     def __init__(self):
         super().__init__()
         self.new_log_level = ""
         self.new_state = ""
 
-    @property
-    def name(self):
-        return 'inactive'
-
     def _enter(self, state_machine):
-        state_machine.system.led_breath.set_color(LED_BLUE)
+        state_machine.system.remember_modem_ok()
+        state_machine.system.start_poll_sensors()
 
         if state_machine.intervalForInactivityEventS < MAX_INACTIVITY_TIME_S:
             state_machine.intervalForInactivityEventS *= EXP_BACKOFF_INACTIVITY
@@ -444,6 +438,9 @@ class StateInactive(State):
         pass
 
     def _update(self, state_machine):
+        # keep the LED breathing, while the sensors are still measuring
+        if not state_machine.system.sensors_ready():
+            return
 
         state_machine.system.poll_sensors()
         event = ({
@@ -454,11 +451,23 @@ class StateInactive(State):
         if not last_log == "":
             event.update({'properties.variables.lastLogContent': {'value': last_log}})
 
-        state_machine.system.send_event(event)
+        # keep the connection for getting the state right afterwards, it is closed there
+        state_machine.system.send_event(event, disconnect=False)
 
         self.new_log_level, self.new_state = state_machine.system.get_state_from_backend()  # CHECK: This might raise an exception which will not be caught, also contains state transitions (recursive enter())
-        log.info("New log level: ({}), new backend state:({})".format(self.new_log_level, self.new_state))
-        log.debug("Increased interval for inactivity events to {}".format(state_machine.intervalForInactivityEventS))
+        log.info("New log level: (%s), new backend state:(%s)", self.new_log_level, self.new_state)
+        log.debug("Increased interval for inactivity events to %s", state_machine.intervalForInactivityEventS)
+
+        # a single failed poll should not reset the system, keep the current level and state instead
+        if self.new_state == "":
+            state_machine.failedBackend_Communications += 1
+            if state_machine.failedBackend_Communications < MAX_FAILED_BACKEND_COMMUNICATIONS:
+                log.warning("Failed to get the state from the backend %d time(s) in a row",
+                            state_machine.failedBackend_Communications)
+                state_machine.go_to_state('waitingForOvershoot')
+                return
+        else:
+            state_machine.failedBackend_Communications = 0
 
         self._adjust_level_state(state_machine, self.new_log_level, self.new_state)
 
@@ -481,22 +490,21 @@ class StateBlinking(State):
     After some time, the state switches back to inactive.
     """
 
+    name = 'blinking'
+
     def __init__(self):
         super().__init__()
-
-    @property
-    def name(self):
-        return 'blinking'
+        self.blinking_deadline = 0
 
     def _enter(self, state_machine):
         state_machine.system.led_breath.set_blinking()
+        self.blinking_deadline = time.ticks_add(self.enter_timestamp, BLINKING_DURATION_S * 1000)
 
     def _exit(self, state_machine):
         state_machine.system.led_breath.reset_blinking()
 
     def _update(self, state_machine):
-        now = time.time()
-        if now >= self.enter_timestamp + BLINKING_DURATION_S:
+        if time.ticks_diff(time.ticks_ms(), self.blinking_deadline) >= 0:
             state_machine.go_to_state('inactive')  # this is necessary to fetch a new state from backend
 
 
@@ -506,16 +514,11 @@ class StateError(State):
     This state should end with a reset of the complete system
     """
 
-    def __init__(self):
-        super().__init__()
-
-    @property
-    def name(self):
-        return 'error'
+    name = 'error'
+    color = LED_RED
 
     def _enter(self, state_machine):
-        if state_machine.system is not None and state_machine.system.led_breath is not None:
-            state_machine.system.led_breath.set_color(LED_RED)
+        pass
 
     def _exit(self, state_machine):
         raise SystemError("exiting the error state should never happen here")
@@ -548,15 +551,11 @@ class StateBootloader(State):
     to try an OTA (Over The Air Update)
     """
 
-    def __init__(self):
-        super().__init__()
-
-    @property
-    def name(self):
-        return 'bootloader'
+    name = 'bootloader'
+    color = LED_WHITE_BRIGHT
 
     def _enter(self, state_machine):
-        state_machine.system.led_breath.set_color(LED_WHITE_BRIGHT)
+        pass
 
     def _exit(self, state_machine):
         raise SystemError("exiting the bootloader state should never happen here")
@@ -566,6 +565,8 @@ class StateBootloader(State):
             state_machine.system.sim.deinit()
 
         finally:
+            # the modem has to be reset after the update
+            set_modem_ok(False)
             time.sleep(1)
             machine.reset()
 
@@ -1,5 +1,6 @@
 import ubinascii
 import ujson as json
+from micropython import const
 from network import LTE
 
 from lib.config import *
@@ -15,8 +16,16 @@ from sensor import MovementSensor
 
 # backlog constants
 EVENT_BACKLOG_FILE = "event_backlog.txt"
-UPP_BACKLOG_FILE = "upp_backlog.txt"
-BACKLOG_MAX_LEN = 10  # max number of events / UPPs in the backlogs
+UPP_BACKLOG_FILE = "upp_backlog.bin"
+UNSIGNED_BACKLOG_FILE = "unsigned_backlog.txt"  # uBirched events stored during the send backoff, still without a UPP
+OLD_UPP_BACKLOG_FILE = "upp_backlog.txt"  # hex encoded UPPs, one per line, used by older versions
+BACKLOG_MAX_LEN = const(10)  # max number of events / UPPs in the backlogs
+
+# after this many consecutive failed sends, the SIM and the modem are not used for sending for a while
+SEND_BACKOFF_FAILURES = const(2)
+SEND_BACKOFF_MS = const(60 * 1000)
+# if more sends fail in a row, the system is reset
+MAX_FAILED_SENDS = const(3)
 
 # get the global logger
 log = logging.getLogger()
@@ -34,12 +43,15 @@ class System:
         self.sim_pin = None
         self.key_name = "ukey"
         self.sim_imsi = None
+        self.sim_pin_file = None
 
         #### Connection ####
         self.connection = None
         self.lte = None
         self.modem = None
         self.failed_sends = 0
+        self.last_failed_send_ms = None
+        self.modem_ok_stored = False
 
         #### uBirch Protocol ####
         self.uBirch_disable = False
@@ -58,6 +70,7 @@ class System:
         ## Initialise all "modules" ####
         self.init_lte_modem()
         self.load_config()
+        migrate_upp_backlog(OLD_UPP_BACKLOG_FILE, UPP_BACKLOG_FILE, BACKLOG_MAX_LEN)
         self.load_sim_pin()
         self.init_sim_proto()
 
@@ -70,21 +83,27 @@ class System:
             if not self.modem:
                 self.modem = Modem(self.lte)
 
-            # reset the LTE modem (ensure that it is in a usable state)
-            log.info("Resetting the LTE modem")
-            self.modem.reset()
-            log.info("Done resetting the LTE modem")
+            # reset the LTE modem (ensure that it is in a usable state), unless only the controller was
+            # restarted, after the modem was marked as usable, and the modem is still attached from before
+            # the mark is only valid once, until the state machine reaches a good state again
+            modem_ok = get_modem_ok()
+            set_modem_ok(False)
+            if machine.reset_cause() == machine.SOFT_RESET and modem_ok and self.lte.isattached():
+                log.info("LTE modem still attached, skipping the reset")
+            else:
+                log.info("Resetting the LTE modem")
+                self.modem.reset()
+                log.info("Done resetting the LTE modem")
 
             # get/log the IMSI
             log.info("Reading the IMSI from the SIM")
             self.sim_imsi = self.modem.get_imsi()
-            log.info("SIM IMSI: %s" % str(self.sim_imsi))
+            self.sim_pin_file = self.sim_imsi + ".bin"
+            log.info("SIM IMSI: %s", self.sim_imsi)
         except Exception as e:
             log.exception("Failed to set up the LTE Modem: %s" % str(e))
 
-            # idle until the watchdog resets the system
-            while True:
-                machine.idle()
+            idle_until_reset()
 
         return
 
@@ -106,15 +125,12 @@ class System:
         except Exception as e:
             log.exception("Failed to load the configuration: %s" % str(e))
 
-            # idle until the watchdog resets the system
-            while True:
-                machine.idle()
+            idle_until_reset()
 
     def load_sim_pin(self):
         """ load the SIM pin from flash or the backend + save it """
-        pin_file = self.sim_imsi + ".bin"
 
-        self.sim_pin = get_pin_from_flash(pin_file, self.sim_imsi)
+        self.sim_pin = get_pin_from_flash(self.sim_pin_file, self.sim_imsi)
 
         # check if a pin was loaded
         if self.sim_pin is None:
@@ -131,7 +147,7 @@ class System:
                 raise(Exception("Error getting the pin: " + str(e)))
 
             # write the pin to flash
-            with open(pin_file, "wb") as f:
+            with open(self.sim_pin_file, "wb") as f:
                 f.write(self.sim_pin.encode())
 
     def init_sim_proto(self):
@@ -146,33 +162,32 @@ class System:
         # unlock the SIM
         try:
             self.sim.init()
-        except Exception as e:
+        except ValueError:
             # if PIN is invalid, there is nothing we can do -> block
-            if isinstance(e, ValueError):
-                self.led_breath.set_color(COLOR_SIM_FAIL)
-                log.critical("PIN is invalid, disabling uBirch-functionality")
-
-                # create an emergency event and try to send it
-                event = ({
-                    'properties.variables.lastError': {
-                        'value': 'PIN is invalid, disabling uBirch-functionality',
-                        'sentAt': formated_time()
-                    }
-                })
-
-                try:
-                    self.send_emergency_event(event)
-                except Exception as e:
-                    raise(Exception("Error informing elevate backend about invalid SIM Pin: " + str(e)))
-
-                # disable uBirching
-                self.uBirch_disable = True
-
-                # delete the loaded - invalid - PIN from flash
-                del_pin_from_flash(self.sim_imsi + ".bin")
-            else:
-                # pass the exception back to the caller -> into the state machine
-                raise(Exception("Failed to unlock the uBirch applet on the SIM: " + str(e)))
+            self.led_breath.set_color(COLOR_SIM_FAIL)
+            log.critical("PIN is invalid, disabling uBirch-functionality")
+
+            # create an emergency event and try to send it
+            event = ({
+                'properties.variables.lastError': {
+                    'value': 'PIN is invalid, disabling uBirch-functionality',
+                    'sentAt': formated_time()
+                }
+            })
+
+            try:
+                self.send_emergency_event(event)
+            except Exception as e:
+                raise(Exception("Error informing elevate backend about invalid SIM Pin: " + str(e)))
+
+            # disable uBirching
+            self.uBirch_disable = True
+
+            # delete the loaded - invalid - PIN from flash
+            del_pin_from_flash(self.sim_pin_file)
+        except Exception as e:
+            # pass the exception back to the caller -> into the state machine
+            raise(Exception("Failed to unlock the uBirch applet on the SIM: " + str(e)))
 
         # read the UUID of the SIM
         if not self.uBirch_disable:
@@ -183,6 +198,12 @@ class System:
 
             log.info("UUID: %s" % str(self.uBirch_uuid))
 
+    def remember_modem_ok(self):
+        """ mark the modem as usable, so it is not reset after a following soft reset """
+        if not self.modem_ok_stored:
+            set_modem_ok(True)
+            self.modem_ok_stored = True
+
     def hard_reset(self):
         """ hard-resets the device by telling the Pysense board to turn the power off/on """
         self.sensor.pysense.reset_cmd()
@@ -195,6 +216,14 @@ class System:
         """
         return self.sensor.overshoot
 
+    def start_poll_sensors(self):
+        """ Start measuring the temperature, without waiting for the result. """
+        self.sensor.start_poll_sensors()
+
+    def sensors_ready(self):
+        """ Check if the values started with start_poll_sensors can be polled. """
+        return self.sensor.sensors_ready()
+
     def poll_sensors(self):
         """ Poll the current temperature and altitude sensor values. """
         self.sensor.poll_sensors()
@@ -215,107 +244,160 @@ class System:
         """ Get the current minimum speed from the filtered sensor. """
         return self.sensor.speed_min
 
-    def send_event(self, event: dict, ubirching: bool = False, debug: bool = True):
+    def send_event(self, event: dict, ubirching: bool = False, debug: bool = True, disconnect: bool = True):
 
         """
         Send the data to eevate and the UPP to uBirch
         :param event: name of the event to send
         :param ubirching: enable/disable sending of UPPs to uBirch
         :param debug: for extra debugging outputs of messages
+        :param disconnect: disconnect after sending, set to False if the connection is used right afterwards
         """
+        ubirching = ubirching and not self.uBirch_disable
+
+        # shortly after consecutive failed sends, only store the event in the backlog, without signing and sending it
+        if self.failed_sends >= SEND_BACKOFF_FAILURES and self.last_failed_send_ms is not None and \
+                time.ticks_diff(time.ticks_ms(), self.last_failed_send_ms) < SEND_BACKOFF_MS:
+            log.info("Last sends failed, storing the event without sending it")
+            serialized_event = serialize_json(event).decode() if ubirching else json.dumps(event)
+            append_backlog([serialized_event], EVENT_BACKLOG_FILE)
+            if ubirching:
+                # the UPP is created with the next send, keep the event in flash until then
+                append_backlog([serialized_event], UNSIGNED_BACKLOG_FILE)
+            return
+
+        # only build the debug outputs, if the logger would print them
+        debug = debug and log.isEnabledFor(logging.DEBUG)
+
+        # the events stored during the backoff still need their UPPs, only the newest ones are kept like in the backlogs
+        unsigned_events = get_backlog(UNSIGNED_BACKLOG_FILE)[-BACKLOG_MAX_LEN:]
+        stored_unsigned_events = len(unsigned_events)
+
         # local variable, which decides if ubirch operations are executed
-        _ubirching = ubirching and not self.uBirch_disable
+        _ubirching = ubirching or len(unsigned_events) > 0
 
         events = list()
         upps = list()
+        sent_events = 0  # number of events from the head of the backlog, which were sent successfully
+        sent_upps = 0  # number of UPPs from the head of the backlog, which were sent successfully
+        stored_events = 0  # number of events from the head of the backlog, which are already stored in flash
+        stored_upps = 0  # number of UPPs from the head of the backlog, which are already stored in flash
+        signed_events = 0  # number of unsigned events, for which a UPP was created
+        sent = False
 
         try:
-            # check if the event should be uBirched
+            # get UPP and event backlog from flash
             if _ubirching:
-                serialized_event = serialize_json(event)
+                upps = get_upp_backlog(UPP_BACKLOG_FILE)
+                stored_upps = len(upps)
+            events = get_backlog(EVENT_BACKLOG_FILE)
+            stored_events = len(events)
 
+            # add new event to the backlog, a uBirched event is sent exactly as it is hashed for the UPP
+            serialized_event = serialize_json(event).decode() if ubirching else json.dumps(event)
+            events.append(serialized_event)
+            if ubirching:
+                unsigned_events.append(serialized_event)
+
+            for unsigned_event in unsigned_events:
                 # use the SIM to create the UPP
                 log.info("Creating a UPP")
-                upp = self.sim.message_chained(self.key_name, serialized_event, hash_before_sign=True)
-                log.info("UPP: %s\n" % ubinascii.hexlify(upp).decode())
+                upp = self.sim.message_chained(self.key_name, unsigned_event.encode(), hash_before_sign=True)
+                if debug:
+                    log.debug("UPP: %s", ubinascii.hexlify(upp))
 
-                # get UPP backlog from flash and add new UPP
-                upps = get_backlog(UPP_BACKLOG_FILE)
-                upps.append(ubinascii.hexlify(upp).decode())
-
-            # get event backlog from flash and add new event
-            events = get_backlog(EVENT_BACKLOG_FILE)
-            events.append(json.dumps(event))
+                # add new UPP to the backlog
+                upps.append(upp)
+                signed_events += 1
 
             # send events
             self.connection.ensure_connection()
 
+            # look up the objects needed for sending only once for both loops
+            sim, modem, connection, uuid = self.sim, self.modem, self.connection, self.uBirch_uuid
+
             try:
-                while len(events) > 0:
+                send_data = self.elevate_api.send_data
+                while sent_events < len(events):
                     if debug:
-                        log.debug("Sending event: {}".format(events[0]))
+                        log.debug("Sending event: %s", events[sent_events])
 
                     # send data message to data service, with reconnects/modem resets if necessary
-                    status_code, content = send_backend_data(self.sim, self.modem, self.connection,
-                                                             self.elevate_api.send_data, self.uBirch_uuid,
-                                                             events[0])
-                    log.debug("RESPONSE: {}".format(content))
+                    status_code, content = send_backend_data(sim, modem, connection, send_data, uuid,
+                                                             events[sent_events])
+                    log.debug("RESPONSE: %s", content)
 
-                    if not 200 <= status_code < 300:
+                    if status_code < 200 or status_code >= 300:
                         log.error("BACKEND RESP {}: {}".format(status_code, content))
                         return
                     else:
                         # event was sent successfully and can be removed from backlog
-                        events.pop(0)
+                        sent_events += 1
 
             except:
                 return
 
-            # send UPPs
-            self.connection.ensure_connection()
-
+            # send UPPs over the same connection
             try:
                 if _ubirching:
-                    while len(upps) > 0:
+                    send_upp = self.uBirch_api.send_upp
+                    while sent_upps < len(upps):
                         if debug:
-                            log.debug("Sending UPP: {}".format(upps[0]))
+                            log.debug("Sending UPP: %s", ubinascii.hexlify(upps[sent_upps]).decode())
 
                         # send UPP to the ubirch authentication service to be anchored to the blockchain
-                        status_code, content = send_backend_data(self.sim, self.modem, self.connection,
-                                                                 self.uBirch_api.send_upp, self.uBirch_uuid,
-                                                                 ubinascii.unhexlify(upps[0]))
+                        status_code, content = send_backend_data(sim, modem, connection, send_upp, uuid,
+                                                                 upps[sent_upps])
                         try:
-                            log.debug("NIOMON RESPONSE: ({}) {}".format(status_code, "" if status_code == 200
-                                                                        else ubinascii.hexlify(content).decode()))
+                            if debug:
+                                log.debug("NIOMON RESPONSE: (%s) %s", status_code, "" if status_code == 200
+                                          else ubinascii.hexlify(content).decode())
                         except:
                             # this is only exception handling in case the content can not be decyphered
                             pass
                         # communication worked in general, now check server response
-                        if not 200 <= status_code < 300 and not status_code == 409:
+                        if (status_code < 200 or status_code >= 300) and status_code != 409:
                             log.error("NIOMON RESP {}".format(status_code))
+                            return
                         else:
                             # UPP was sent successfully and can be removed from backlog
-                            upps.pop(0)
+                            sent_upps += 1
                 else:
                     pass
             except:
                 # sending failed, terminate
                 return
 
+            sent = True
+            # only consecutive failures should lead to a reset
+            self.failed_sends = 0
+
         except Exception as e:
             # if too many communications fail, reset the system
             self.failed_sends += 1
-            if self.failed_sends > 3:
-                raise(Exception("Failed to send a message within 3 tries: " + str(e)))
+            if self.failed_sends > MAX_FAILED_SENDS:
+                raise(Exception("Failed to send a message within {} tries: {}".format(MAX_FAILED_SENDS, e)))
             else:
-                log.exception(str(e))
+                log.exception("Failed to send a message")
 
         finally:
             # make sure to store the unsent events and UPPs to the backlog files and disconnect connection
-            write_backlog(events, EVENT_BACKLOG_FILE, BACKLOG_MAX_LEN)
-            if _ubirching:
-                write_backlog(upps, UPP_BACKLOG_FILE, BACKLOG_MAX_LEN)
-            self.connection.disconnect()
+            # the backlogs are only rewritten, if something was sent or they got too long, otherwise new entries are appended
+            if sent_events > 0 or len(events) > BACKLOG_MAX_LEN:
+                write_backlog(events[sent_events:], EVENT_BACKLOG_FILE, BACKLOG_MAX_LEN)
+            elif len(events) > stored_events:
+                append_backlog(events[stored_events:], EVENT_BACKLOG_FILE)
+            if sent_upps > 0 or len(upps) > BACKLOG_MAX_LEN:
+                write_upp_backlog(upps[sent_upps:], UPP_BACKLOG_FILE, BACKLOG_MAX_LEN)
+            elif len(upps) > stored_upps:
+                append_upp_backlog(upps[stored_upps:], UPP_BACKLOG_FILE)
+            # events, for which the UPP could not be created, are signed with the next send
+            if signed_events > 0 or len(unsigned_events) > stored_unsigned_events:
+                write_backlog(unsigned_events[signed_events:], UNSIGNED_BACKLOG_FILE, BACKLOG_MAX_LEN)
+            if disconnect or not sent:
+                self.connection.disconnect()
+            # start the backoff, if the send failed
+            self.last_failed_send_ms = None if sent else time.ticks_ms()
 
         return
 
@@ -327,7 +409,7 @@ class System:
         """
         # make the elevate data package
         event_string = json.dumps(event)
-        log.debug("Sending Elevate HTTP request body: {}".format(event_string))
+        log.debug("Sending Elevate HTTP request body: %s", event_string)
 
         try:
             self.connection.ensure_connection()
@@ -335,7 +417,7 @@ class System:
             _, content = send_backend_data(self.sim, self.modem, self.connection,
                                            self.elevate_api.send_data, self.uBirch_uuid,
                                            event_string)
-            log.debug("RESPONSE: {}".format(content))
+            log.debug("RESPONSE: %s", content)
 
         except Exception as e:
             raise(Exception("Failed to send an emergency event: " + str(e)))
@@ -346,24 +428,28 @@ class System:
 
     def get_state_from_backend(self):
         """
-        Get the current state and log level from the elevate backend
+        Get the current state and log level from the elevate backend.
         :return: log level and new state or ("", "") in case of an error
         """
-        level = ""      # level will be handled from helpers.translate_backend_log_level()
-        state = ""      # state will be handled from helpers.translate_backend_state_name()
+        # the caller keeps the connection of the preceding event send open for this poll,
+        # without one the backend was not reachable right before, so do not wake up the modem again
+        if not self.connection.isconnected():
+            log.warning("No connection for getting the state from the backend")
+            return "", ""
 
         # send data message to data service, with reconnects/modem resets if necessary
         try:
-            self.connection.ensure_connection()
             status_code, level, state = send_backend_data(self.sim, self.modem, self.connection,
-                                                          self.elevate_api.get_state, self.uBirch_uuid, '')
+                                                          self.elevate_api.get_state, self.uBirch_uuid, '',
+                                                          want_body=False)
             # communication worked in general, now check server response
-            if not 200 <= status_code < 300:
+            if status_code < 200 or status_code >= 300:
                 log.error("Elevate backend returned HTTP error code {}".format(status_code))
+            return level, state
         except Exception as e:
             # only log the exception - error detection is done by the state machine when looking up the level/state
-            log.exception(str(e))
+            log.exception("Failed to get the state from the backend")
+            # "" will be handled from helpers.translate_backend_log_level() / translate_backend_state_name()
+            return "", ""
         finally:
             self.connection.disconnect()
-
-        return level, state
@@ -11,6 +11,23 @@
 import time
 import _thread
 
+STOP_CHECK_INTERVAL_US = 50000  # longest sleep, before checking if the mock sensor was stopped
+
+# the ticks functions only exist on MicroPython, off the device a monotonic clock is used instead
+if hasattr(time, "ticks_us"):
+  _ticks_us = time.ticks_us
+  _ticks_add = time.ticks_add
+  _ticks_diff = time.ticks_diff
+else:
+  def _ticks_us():
+    return int(time.monotonic() * 1000000)
+
+  def _ticks_add(ticks, delta):
+    return ticks + delta
+
+  def _ticks_diff(ticks1, ticks2):
+    return ticks1 - ticks2
+
 #
 # Initialisation parameters:
 #   data_file: The file to read from
@@ -27,13 +44,13 @@ class MockAccelerometer:
     self.fifo_full_cb_pin = fifo_full_cb_pin
     self.fifo_lock = None
     self.stopped = True
+    self.run_id = 0         # increased by every start(), a feeding thread of an older run stops itself
     self.loop_count = 0
 
-    self.value_lines = []   # stores parsed values from the data file
     self.loop = loop_data   # controls whether the data from data_file should be looped or not
     self.batch_time = 32/75 # time until the current batch of values should be written to the fifo
                             # (75 values/second -> 0.426... seconds/batch)
-    self.fifo = []          # stores the current batch of values (32) ("FIFO")
+    self.fifo = [0] * 32    # stores the current batch of values (32) ("FIFO"), reused for every batch
     self.fifo_index = 0     # stores the current fifo index
 
     # create the fifo lock
@@ -42,9 +59,6 @@ class MockAccelerometer:
     # clear the fifo
     self.restart_fifo()
 
-    # parse input data
-    self.parse_data()
-
     return
 
   def open_data_file(self):
@@ -57,7 +71,7 @@ class MockAccelerometer:
 
   def acceleration(self):
     """ returns the current acceleration values """
-    return tuple(self.fifo.copy())
+    return tuple(self.fifo)
 
   def enable_fifo_interrupt(self, cb):
     """ set the function to be called when the fifo is full """
@@ -66,7 +80,8 @@ class MockAccelerometer:
   def restart_fifo(self):
     """ clear the fifo """
     with self.fifo_lock:
-      self.fifo = [0] * 32
+      for i in range(32):
+        self.fifo[i] = 0
 
   def fifo_write(self, value):
     """ writes a value to the fifo """
@@ -83,8 +98,18 @@ class MockAccelerometer:
         if self.fifo_full_cb != None:
           self.fifo_full_cb(self.fifo_full_cb_pin)
 
+  def fifo_write_batch(self, values):
+    """ writes a full batch of values to the fifo at once """
+    with self.fifo_lock:
+      self.fifo[:] = values
+      self.fifo_index = 0
+
+      # the fifo is "full" now, check if a callback is registered
+      if self.fifo_full_cb != None:
+        self.fifo_full_cb(self.fifo_full_cb_pin)
+
   def parse_data(self):
-    """ reads the data file and stores its values """
+    """ reads the data file line by line and yields its values, so only one batch is kept in memory """
     # open the file
     self.open_data_file()
 
@@ -94,33 +119,42 @@ class MockAccelerometer:
     #   the time in seconds
     #   the time in milliseconds
     # these timestamps will be ignored since a constant sampling rate of 75Hz is assumed
-    for line in self.fd.readlines():
-      # remove the trailing newline
-      line.rstrip("\n")
-
-      # split the line into a list and convert each value into a float
-      # cut of the first two values (timestamps) and add the list to value_lines
-      self.value_lines.append(list(map(lambda x: float(x), line.split(",")[2:-1])))
-
-    # close the file
-    self.close_data_file()
-
-  def _loop(self, _):
+    try:
+      for line in self.fd:
+        # split the line into a list and convert each value into a float
+        # cut of the first two values (timestamps)
+        yield [float(x) for x in line.split(",")[2:-1]]
+    finally:
+      # close the file
+      self.close_data_file()
+
+  def _wait_for_stop(self, deadline, run_id):
+    """ sleep in short slices until the deadline, returns True as soon as this run was stopped """
+    while not self.stopped and self.run_id == run_id:
+      remaining = _ticks_diff(deadline, _ticks_us())
+      if remaining <= 0:
+        return False
+      time.sleep(min(remaining, STOP_CHECK_INTERVAL_US) / 1000000)
+    return True
+
+  def _loop(self, run_id):
     """ read data from the file and feed it into the fifo """
-    while True:
-      for values in self.value_lines:
-        # write values to the fifo
-        for value in values:
-          # write the value
-          self.fifo_write(value)
+    # the batches are written on a fixed schedule, so the runtime of the loop does not add up
+    batch_us = int(self.batch_time * 1000000)
+    next_batch = _ticks_us()
 
-          # wait for 1/75 seconds - some compensation for runtime
-          time.sleep((990 / 75) / 1000)
-
-        # check for self.stopped after every batch of values
-        if self.stopped == True:
+    while True:
+      batches = self.parse_data()
+      for values in batches:
+        # wait until the batch would be complete, a stop() ends the wait right away
+        next_batch = _ticks_add(next_batch, batch_us)
+        if self._wait_for_stop(next_batch, run_id):
+          batches.close()
           _thread.exit()
 
+        # write the batch to the fifo at once
+        self.fifo_write_batch(values)
+
       # check if the file (-> the values) should be looped
       if self.loop != True:
         break
@@ -132,10 +166,12 @@ class MockAccelerometer:
   def start(self):
     """ start the mock sensor """
     # check if the mock sensor is currently running
-    if self.stopped == True:
+    if self.stopped:
       self.stopped = False
+      # a feeding thread, which did not notice the last stop() yet, ends because of the new run id
+      self.run_id += 1
 
-      _thread.start_new_thread(self._loop, (0, ))
+      _thread.start_new_thread(self._loop, (self.run_id, ))
     else:
       # ignore the start-call
       return
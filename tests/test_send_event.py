@@ -0,0 +1,149 @@
+#
+# Tests for the backlog handling of System.send_event, run on the host with CPython
+# The pycom/MicroPython only modules are replaced by small stand-ins, before the system module is imported
+#
+
+import binascii
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, "lib")]
+
+
+def _stub_module(name, **attributes):
+  module = types.ModuleType(name)
+  module.__dict__.update(attributes)
+  sys.modules.setdefault(name, module)
+
+
+def _ticks_ms():
+  return int(time.monotonic() * 1000)
+
+
+class _LTE:
+  pass
+
+
+_stub_module("micropython", const=lambda value: value, native=lambda f: f, viper=lambda f: f)
+_stub_module("network", LTE=_LTE)
+_stub_module("machine", PWRON_RESET=0, HARD_RESET=1, WDT_RESET=2, DEEPSLEEP_RESET=3, SOFT_RESET=4,
+             BROWN_OUT_RESET=5, reset_cause=lambda: 0, reset=lambda: None)
+_stub_module("pycom", nvs_get=lambda key: None, nvs_set=lambda key, value: None, nvs_erase=lambda key: None,
+             heartbeat=lambda on: None, rgbled=lambda color: None)
+_stub_module("ubinascii", hexlify=binascii.hexlify, unhexlify=binascii.unhexlify, b2a_base64=binascii.b2a_base64)
+_stub_module("ujson", dumps=json.dumps, loads=json.loads, load=json.load)
+_stub_module("uos", stat=os.stat, remove=os.remove, rename=os.rename, listdir=os.listdir)
+_stub_module("ustruct", pack=struct.pack, unpack=struct.unpack, unpack_from=struct.unpack_from,
+             pack_into=struct.pack_into, calcsize=struct.calcsize)
+_stub_module("utime", ticks_ms=_ticks_ms, ticks_diff=lambda ticks1, ticks2: ticks1 - ticks2,
+             ticks_add=lambda ticks, delta: ticks + delta, sleep_ms=lambda ms: None, time=time.time,
+             localtime=time.localtime, sleep=lambda s: None)
+_stub_module("uio", StringIO=__import__("io").StringIO)
+_stub_module("usocket")
+# the sensor runs on its own thread with the accelerometer, it is not needed for sending
+_stub_module("sensor", MovementSensor=object)
+
+import system  # noqa: E402
+
+EVENT = {"id": "test", "data": {"b": 1, "a": 2}}
+UPP = b"\x96\x23\x00upp"
+
+
+class _Sim:
+  def __init__(self):
+    self.payloads = []
+
+  def message_chained(self, name, payload, hash_before_sign=False):
+    self.payloads.append(payload)
+    return UPP
+
+
+class _Connection:
+  def __init__(self):
+    self.disconnected = False
+
+  def ensure_connection(self):
+    pass
+
+  def disconnect(self):
+    self.disconnected = True
+
+
+class _Api:
+  def send_data(self, uuid, message):
+    pass
+
+  def send_upp(self, uuid, message):
+    pass
+
+
+class TestSendEvent(unittest.TestCase):
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.tmp_dir = tempfile.TemporaryDirectory()
+    os.chdir(self.tmp_dir.name)
+
+    # build the system without initialising the hardware
+    self.system = system.System.__new__(system.System)
+    self.system.uBirch_disable = False
+    self.system.uBirch_uuid = None
+    self.system.key_name = "ukey"
+    self.system.sim = _Sim()
+    self.system.modem = None
+    self.system.connection = _Connection()
+    self.system.elevate_api = _Api()
+    self.system.uBirch_api = _Api()
+    self.system.failed_sends = 0
+    self.system.last_failed_send_ms = None
+
+    # the elevate backend answers with an error
+    self.send_backend_data = system.send_backend_data
+    system.send_backend_data = lambda *args, **kwargs: (500, b"internal error")
+
+  def tearDown(self):
+    system.send_backend_data = self.send_backend_data
+    os.chdir(self.cwd)
+    self.tmp_dir.cleanup()
+
+  def test_failed_ubirched_send_is_stored_in_both_backlogs(self):
+    self.system.send_event(EVENT, ubirching=True)
+
+    serialized_event = system.serialize_json(EVENT)
+    self.assertEqual(self.system.sim.payloads, [serialized_event])
+    self.assertEqual(system.get_backlog(system.EVENT_BACKLOG_FILE), [serialized_event.decode()])
+    self.assertEqual(system.get_upp_backlog(system.UPP_BACKLOG_FILE), [UPP])
+    self.assertTrue(self.system.connection.disconnected)
+    self.assertIsNotNone(self.system.last_failed_send_ms)
+
+  def test_deferred_ubirched_event_is_signed_with_the_next_send(self):
+    self.system.failed_sends = system.SEND_BACKOFF_FAILURES
+    self.system.last_failed_send_ms = _ticks_ms()
+    self.system.send_event(EVENT, ubirching=True)
+
+    # during the backoff, the event is only stored, and it does not count as a failed send
+    serialized_event = system.serialize_json(EVENT).decode()
+    self.assertEqual(self.system.sim.payloads, [])
+    self.assertEqual(self.system.failed_sends, system.SEND_BACKOFF_FAILURES)
+    self.assertEqual(system.get_backlog(system.EVENT_BACKLOG_FILE), [serialized_event])
+    self.assertEqual(system.get_backlog(system.UNSIGNED_BACKLOG_FILE), [serialized_event])
+
+    # after the backoff, the stored event gets its UPP, even if the new event is not uBirched
+    self.system.last_failed_send_ms = None
+    self.system.send_event({"id": "plain"})
+
+    self.assertEqual(self.system.sim.payloads, [serialized_event.encode()])
+    self.assertEqual(system.get_backlog(system.EVENT_BACKLOG_FILE), [serialized_event, json.dumps({"id": "plain"})])
+    self.assertEqual(system.get_upp_backlog(system.UPP_BACKLOG_FILE), [UPP])
+    self.assertFalse(os.path.exists(system.UNSIGNED_BACKLOG_FILE))
+
+
+if __name__ == "__main__":
+  unittest.main()